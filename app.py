@@ -1,9 +1,24 @@
 # app.py - Qwery AI RAG Service
 from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from starlette.background import BackgroundTask
+from starlette.concurrency import run_in_threadpool
+from pydantic import BaseModel, Field
 import psycopg2
-import requests
+import psycopg2.extensions
+from psycopg2.extras import Json
+from psycopg2.pool import ThreadedConnectionPool
+from pgvector.psycopg2 import register_vector
+import numpy as np
+import httpx
+import orjson
+from cachetools import TTLCache
+import asyncio
 import os
+import threading
+import itertools
+from contextlib import ExitStack, contextmanager
 from typing import List, Optional
 import logging
 
@@ -14,8 +29,10 @@ logger = logging.getLogger(__name__)
 app = FastAPI(
     title="Qwery AI RAG Service",
     description="Vector similarity search and RAG service",
-    version="1.0.0"
+    version="1.0.0",
+    default_response_class=ORJSONResponse
 )
+app.add_middleware(GZipMiddleware, minimum_size=1024)
 
 # Database configuration
 DB_CONFIG = {
@@ -25,11 +42,103 @@ DB_CONFIG = {
     "user": os.getenv("POSTGRES_USER", "qweryai"),
     "password": os.getenv("POSTGRES_PASSWORD")
 }
+# Pool size is per uvicorn worker: workers x replicas x DB_POOL_MAX must stay
+# below the server's max_connections
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "4"))
+# Seconds a request waits for a free pooled connection
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+
+# Per-session vector index search settings (HNSW candidate list, IVFFlat probes)
+HNSW_EF_SEARCH = int(os.getenv("HNSW_EF_SEARCH", "40"))
+IVFFLAT_PROBES = int(os.getenv("IVFFLAT_PROBES", "10"))
+
+# Binary-quantized search: when > 0, candidates are fetched from a bit index
+# (ETL INDEX_TYPE=binary) and this many times the limit are reranked
+BINARY_RERANK_FACTOR = int(os.getenv("BINARY_RERANK_FACTOR", "0"))
+# pgvector's upper bound for hnsw.ef_search
+HNSW_EF_SEARCH_MAX = 1000
+
+# Distance is computed once per candidate; the threshold is applied to the
+# index-ordered top rows, which gives the same rows as filtering first.
+# Embeddings are unit length, so cosine similarity is the inner product
+# and <#> (negative inner product) skips the norm computations
+SEARCH_SQL = """
+    WITH scored AS (
+        SELECT id, content, metadata, embedding <#> $1::halfvec AS distance
+        FROM documents
+        ORDER BY embedding <#> $1::halfvec
+        LIMIT $3
+    )
+    SELECT id, content, metadata, -distance as similarity
+    FROM scored
+    WHERE -distance > $2
+    ORDER BY distance
+"""
+
+# Hamming distance over binary_quantize() picks the candidates, which are
+# then reranked by the full-precision inner product. {dimensions} is the
+# embedding column's declared size, the same cast the ETL's bit index uses
+BINARY_SEARCH_SQL = """
+    WITH candidates AS (
+        SELECT id, content, metadata, embedding
+        FROM documents
+        ORDER BY binary_quantize(embedding)::bit({dimensions})
+                 <~> binary_quantize($1::halfvec)
+        LIMIT $3 * {factor}
+    ), scored AS (
+        SELECT id, content, metadata, embedding <#> $1::halfvec AS distance
+        FROM candidates
+        ORDER BY distance
+        LIMIT $3
+    )
+    SELECT id, content, metadata, -distance as similarity
+    FROM scored
+    WHERE -distance > $2
+    ORDER BY distance
+"""
+
+# Statements prepared once per pooled connection and run with EXECUTE
+PREPARED_STATEMENTS = {
+    "insert_document": """
+        INSERT INTO documents (content, embedding, metadata)
+        VALUES ($1, $2, $3) RETURNING id
+    """,
+    "search_documents": SEARCH_SQL,
+}
+
+# Rows fetched per round-trip when streaming document listings
+LIST_STREAM_ITERSIZE = 256
 
 # Embedding configuration
 EMBEDDING_MODEL_URL = os.getenv("EMBEDDING_MODEL_URL", "http://ollama:11434")
 EMBEDDING_MODEL_NAME = os.getenv("EMBEDDING_MODEL_NAME", "llama2")
 
+# How long Ollama keeps the embedding model loaded after a request
+OLLAMA_KEEP_ALIVE = os.getenv("OLLAMA_KEEP_ALIVE", "30m")
+OLLAMA_POOL_SIZE = int(os.getenv("OLLAMA_POOL_SIZE", "32"))
+# Queries per /api/search/batch request; their embeddings are fetched
+# concurrently, so keep this below OLLAMA_POOL_SIZE
+BATCH_SEARCH_MAX_QUERIES = int(os.getenv("BATCH_SEARCH_MAX_QUERIES", "16"))
+
+# Shared Ollama client so embedding calls reuse keep-alive connections; idle
+# sockets are kept for a minute instead of httpx's 5s default
+ollama_client = httpx.AsyncClient(
+    base_url=EMBEDDING_MODEL_URL,
+    timeout=30,
+    limits=httpx.Limits(
+        max_connections=OLLAMA_POOL_SIZE,
+        max_keepalive_connections=OLLAMA_POOL_SIZE,
+        keepalive_expiry=60
+    )
+)
+
+# In-process cache of query embeddings, keyed by (model, text)
+embedding_cache = TTLCache(
+    maxsize=int(os.getenv("EMBEDDING_CACHE_SIZE", "10000")),
+    ttl=int(os.getenv("EMBEDDING_CACHE_TTL", "3600"))
+)
+embedding_cache_lock = threading.Lock()
+
 class Document(BaseModel):
     content: str
     metadata: Optional[dict] = {}
@@ -39,24 +148,156 @@ class SearchQuery(BaseModel):
     limit: int = 5
     threshold: float = 0.7
 
-def get_db_connection():
-    """Get database connection"""
-    return psycopg2.connect(**DB_CONFIG)
+class BatchSearchQuery(BaseModel):
+    queries: List[str] = Field(min_length=1, max_length=BATCH_SEARCH_MAX_QUERIES)
+    limit: int = 5
+    threshold: float = 0.7
+
+class PooledConnection(psycopg2.extensions.connection):
+    """Connection that remembers whether its session has been set up"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.initialized = False
+
+db_pool = None
+db_pool_lock = threading.Lock()
+# getconn() fails immediately when the pool is empty, so callers wait here
+db_pool_slots = threading.BoundedSemaphore(DB_POOL_MAX)
+
+def get_db_pool():
+    """Create the connection pool on first use so startup does not need the database"""
+    global db_pool
+    with db_pool_lock:
+        if db_pool is None:
+            # putconn() closes connections beyond minconn, so keep every one open
+            db_pool = ThreadedConnectionPool(
+                DB_POOL_MAX, DB_POOL_MAX, connection_factory=PooledConnection, **DB_CONFIG
+            )
+    return db_pool
+
+@app.on_event("shutdown")
+async def close_clients():
+    """Close all pooled database and Ollama connections"""
+    if db_pool:
+        db_pool.closeall()
+    await ollama_client.aclose()
+
+def init_connection(conn):
+    """Register the vector type, tune index search and prepare statements for a new session"""
+    register_vector(conn)
+    with conn.cursor() as cur:
+        cur.execute(f"SET hnsw.ef_search = {HNSW_EF_SEARCH}")
+        cur.execute(f"SET ivfflat.probes = {IVFFLAT_PROBES}")
+        statements = dict(PREPARED_STATEMENTS)
+        if BINARY_RERANK_FACTOR:
+            cur.execute(
+                "SELECT atttypmod FROM pg_attribute "
+                "WHERE attrelid = 'documents'::regclass AND attname = 'embedding'"
+            )
+            statements["search_documents"] = BINARY_SEARCH_SQL.format(
+                dimensions=cur.fetchone()[0], factor=BINARY_RERANK_FACTOR
+            )
+        for name, sql in statements.items():
+            cur.execute(f"PREPARE {name} AS {sql}")
+    conn.commit()
+    conn.initialized = True
 
-def generate_embedding(text: str) -> List[float]:
+@contextmanager
+def db_connection(timeout: float = DB_POOL_TIMEOUT):
+    """Borrow a database connection from the pool, waiting for a free one"""
+    if not db_pool_slots.acquire(timeout=timeout):
+        raise TimeoutError(f"No database connection available within {timeout}s")
+    try:
+        pool = get_db_pool()
+        conn = pool.getconn()
+        try:
+            if not conn.initialized:
+                init_connection(conn)
+            yield conn
+        finally:
+            # Discard connections whose setup failed part-way through
+            pool.putconn(conn, close=not conn.initialized)
+    finally:
+        db_pool_slots.release()
+
+async def generate_embedding(text: str) -> np.ndarray:
     """Generate embedding using Ollama"""
     try:
-        response = requests.post(
-            f"{EMBEDDING_MODEL_URL}/api/embeddings",
-            json={"model": EMBEDDING_MODEL_NAME, "prompt": text},
-            timeout=30
+        response = await ollama_client.post(
+            "/api/embeddings",
+            json={"model": EMBEDDING_MODEL_NAME, "prompt": text, "keep_alive": OLLAMA_KEEP_ALIVE}
         )
         response.raise_for_status()
-        return response.json()["embedding"]
+        embedding = np.array(response.json()["embedding"], dtype=np.float32)
+        # Store and query unit vectors so inner product equals cosine similarity
+        norm = np.linalg.norm(embedding)
+        return embedding / norm if norm else embedding
     except Exception as e:
         logger.error(f"Error generating embedding: {e}")
         raise HTTPException(status_code=500, detail=f"Embedding generation failed: {str(e)}")
 
+async def get_query_embedding(text: str) -> np.ndarray:
+    """Generate a query embedding, reusing cached results for repeated queries"""
+    key = (EMBEDDING_MODEL_NAME, text)
+    with embedding_cache_lock:
+        embedding = embedding_cache.get(key)
+    if embedding is None:
+        embedding = await generate_embedding(text)
+        # Cached arrays are shared between requests
+        embedding.flags.writeable = False
+        with embedding_cache_lock:
+            embedding_cache[key] = embedding
+    return embedding
+
+@app.on_event("startup")
+async def warm_up_embedding_model():
+    """Load the embedding model in Ollama and open a connection before the first request"""
+    try:
+        await generate_embedding("warmup")
+        logger.info("Embedding model warmed up")
+    except Exception as e:
+        logger.warning(f"Embedding model warm-up failed: {e}")
+
+def insert_document(doc: Document, embedding: np.ndarray) -> int:
+    """Insert a document and its embedding, returning the new ID"""
+    with db_connection() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            "EXECUTE insert_document (%s, %s, %s)",
+            (doc.content, embedding, Json(doc.metadata))
+        )
+        doc_id = cur.fetchone()[0]
+        conn.commit()
+        cur.close()
+    return doc_id
+
+def search_similar(embeddings: List[np.ndarray], threshold: float, limit: int) -> List[list]:
+    """Run the similarity search for each query embedding on one connection"""
+    with db_connection() as conn:
+        cur = conn.cursor()
+        if BINARY_RERANK_FACTOR:
+            # HNSW returns at most ef_search rows, so widen it to cover every candidate
+            ef_search = min(max(HNSW_EF_SEARCH, limit * BINARY_RERANK_FACTOR), HNSW_EF_SEARCH_MAX)
+            cur.execute(f"SET LOCAL hnsw.ef_search = {ef_search}")
+        results = []
+        for embedding in embeddings:
+            cur.execute(
+                "EXECUTE search_documents (%s, %s, %s)",
+                (embedding, threshold, limit)
+            )
+            results.append([
+                {
+                    "id": r[0],
+                    "content": r[1],
+                    "metadata": r[2],
+                    "similarity": float(r[3])
+                }
+                for r in cur.fetchall()
+            ])
+        cur.close()
+    return results
+
 @app.get("/health")
 def health_check():
     """Health check endpoint"""
@@ -66,30 +307,21 @@ def health_check():
 def readiness_check():
     """Readiness check endpoint"""
     try:
-        conn = get_db_connection()
-        conn.close()
+        with db_connection(timeout=1) as conn:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
         return {"status": "ready"}
     except Exception as e:
         logger.error(f"Readiness check failed: {e}")
         raise HTTPException(status_code=503, detail=str(e))
 
 @app.post("/api/documents")
-def add_document(doc: Document):
+async def add_document(doc: Document):
     """Add a document with vector embedding"""
     try:
         logger.info(f"Adding document: {doc.content[:50]}...")
-        embedding = generate_embedding(doc.content)
-
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute(
-            "INSERT INTO documents (content, embedding, metadata) VALUES (%s, %s, %s) RETURNING id",
-            (doc.content, embedding, doc.metadata)
-        )
-        doc_id = cur.fetchone()[0]
-        conn.commit()
-        cur.close()
-        conn.close()
+        embedding = await generate_embedding(doc.content)
+        doc_id = await run_in_threadpool(insert_document, doc, embedding)
 
         logger.info(f"Document added with ID: {doc_id}")
         return {"id": doc_id, "status": "success"}
@@ -98,74 +330,85 @@ def add_document(doc: Document):
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/api/search")
-def search_documents(query: SearchQuery):
+async def search_documents(query: SearchQuery):
     """Search documents using vector similarity"""
     try:
         logger.info(f"Searching for: {query.query}")
-        query_embedding = generate_embedding(query.query)
-
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute(
-            """
-            SELECT id, content, metadata, 
-                   1 - (embedding <=> %s) as similarity
-            FROM documents
-            WHERE 1 - (embedding <=> %s) > %s
-            ORDER BY embedding <=> %s
-            LIMIT %s
-            """,
-            (query_embedding, query_embedding, query.threshold, query_embedding, query.limit)
-        )
-        results = cur.fetchall()
-        cur.close()
-        conn.close()
+        query_embedding = await get_query_embedding(query.query)
+        results = (await run_in_threadpool(
+            search_similar, [query_embedding], query.threshold, query.limit
+        ))[0]
 
         logger.info(f"Found {len(results)} results")
-        return {
-            "results": [
-                {
-                    "id": r[0],
-                    "content": r[1],
-                    "metadata": r[2],
-                    "similarity": float(r[3])
-                }
-                for r in results
-            ]
-        }
+        return {"results": results}
     except Exception as e:
         logger.error(f"Error searching documents: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/api/search/batch")
+async def search_documents_batch(query: BatchSearchQuery):
+    """Search documents for several queries, embedding them concurrently"""
+    try:
+        logger.info(f"Batch searching {len(query.queries)} queries")
+        query_embeddings = await asyncio.gather(
+            *(get_query_embedding(q) for q in query.queries)
+        )
+        results = await run_in_threadpool(
+            search_similar, query_embeddings, query.threshold, query.limit
+        )
+        return {"results": results}
+    except Exception as e:
+        logger.error(f"Error batch searching documents: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+def stream_documents(cur, first_rows, cleanup):
+    """Yield documents as NDJSON lines, continuing from an open server-side cursor"""
+    try:
+        for r in itertools.chain(first_rows, cur):
+            yield orjson.dumps({
+                "id": r[0],
+                "content": r[1],
+                "metadata": r[2],
+                "created_at": r[3]
+            }) + b"\n"
+    except Exception as e:
+        # Headers are already sent; abort so the client sees a truncated body
+        logger.error(f"Error streaming documents: {e}")
+        raise
+    finally:
+        # Starlette skips the background task when the stream raises
+        cleanup.close()
+
 @app.get("/api/documents")
 def list_documents(limit: int = 10, offset: int = 0):
-    """List all documents"""
+    """List all documents as newline-delimited JSON"""
+    # The connection outlives this function and is returned once the stream
+    # ends; the background task covers clients that disconnect early
+    cleanup = ExitStack()
     try:
-        conn = get_db_connection()
-        cur = conn.cursor()
+        conn = cleanup.enter_context(db_connection())
+        cur = cleanup.enter_context(conn.cursor(name="documents_stream"))
+        cur.itersize = LIST_STREAM_ITERSIZE
         cur.execute(
             "SELECT id, content, metadata, created_at FROM documents ORDER BY created_at DESC LIMIT %s OFFSET %s",
             (limit, offset)
         )
-        results = cur.fetchall()
-        cur.close()
-        conn.close()
-
-        return {
-            "documents": [
-                {
-                    "id": r[0],
-                    "content": r[1],
-                    "metadata": r[2],
-                    "created_at": r[3].isoformat() if r[3] else None
-                }
-                for r in results
-            ]
-        }
+        # Fetch the first batch before the 200 goes out so failures return a 500
+        first_rows = cur.fetchmany(LIST_STREAM_ITERSIZE)
     except Exception as e:
+        cleanup.close()
         logger.error(f"Error listing documents: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+    return StreamingResponse(
+        stream_documents(cur, first_rows, cleanup),
+        media_type="application/x-ndjson",
+        # GZipMiddleware passes encoded responses through, so rows are not
+        # held back in the compressor's buffer
+        headers={"Content-Encoding": "identity"},
+        background=BackgroundTask(cleanup.close)
+    )
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
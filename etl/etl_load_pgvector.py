@@ -6,13 +6,19 @@ Extracts text from documents, generates embeddings, and loads into pgvector
 
 import os
 import sys
+import math
+import io
+import queue
+import struct
+import threading
 import psycopg2
-from psycopg2.extras import execute_values
 import numpy as np
+import torch
 from sentence_transformers import SentenceTransformer
 import logging
 from pathlib import Path
 import json
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
 # Configure logging
@@ -22,6 +28,10 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# PostgreSQL binary COPY framing: signature, flags and header extension length
+PGCOPY_HEADER = b'PGCOPY\n\xff\r\n\x00' + struct.pack('!ii', 0, 0)
+PGCOPY_TRAILER = struct.pack('!h', -1)
+
 
 class PgVectorETL:
     """ETL pipeline for loading documents into PostgreSQL with pgvector"""
@@ -66,37 +76,189 @@ class PgVectorETL:
                         id SERIAL PRIMARY KEY,
                         content TEXT NOT NULL,
                         metadata JSONB,
-                        embedding vector({self.embedding_dim}),
+                        embedding halfvec({self.embedding_dim}),
                         created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                         updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
                     );
                 """)
 
-                # Create index for vector similarity search
+                self.conn.commit()
+
+            logger.info("✅ pgvector initialized and tables created")
+            return True
+        except Exception as e:
+            logger.error(f"❌ Failed to initialize pgvector: {e}")
+            self.conn.rollback()
+            return False
+
+    def create_vector_index(self, maintenance_work_mem='2GB', parallel_workers=3,
+                            index_type='hnsw', rebuild=False):
+        """
+        Create the vector similarity index once the table is populated
+
+        Building after the bulk load lets the index be sized to the data and
+        avoids maintaining it row by row during the load.
+
+        Args:
+            maintenance_work_mem (str): Memory for the index build, so the
+                graph does not spill to disk
+            parallel_workers (int): Parallel maintenance workers for the build
+            index_type (str): "hnsw", "ivfflat" or "binary" (HNSW over
+                binary-quantized embeddings, for Hamming-distance prefiltering)
+            rebuild (bool): Rebuild an existing index even when it already
+                matches the parameters sized to the current row count
+
+        Returns:
+            bool: Success status
+        """
+        try:
+            with self.conn.cursor() as cur:
+                cur.execute("ANALYZE documents;")
+                cur.execute("SELECT reltuples::bigint FROM pg_class WHERE relname = 'documents';")
+                row_count = max(cur.fetchone()[0], 0)
+
+                index_key = "embedding halfvec_ip_ops"
+                if index_type == 'binary':
+                    # 1 bit per dimension, searched by Hamming distance. The cast
+                    # uses the column's declared size, as the API's query does
+                    cur.execute("""
+                        SELECT atttypmod FROM pg_attribute
+                        WHERE attrelid = 'documents'::regclass AND attname = 'embedding';
+                    """)
+                    dimensions = cur.fetchone()[0]
+                    index_key = f"(binary_quantize(embedding)::bit({dimensions})) bit_hamming_ops"
+
+                if index_type == 'ivfflat':
+                    index_method = "ivfflat"
+                    index_params = {"lists": self._ivfflat_lists(row_count)}
+                else:
+                    m, ef_construction = self._hnsw_params(row_count)
+                    index_method = "hnsw"
+                    index_params = {"m": m, "ef_construction": ef_construction}
+                index_options = ", ".join(f"{k} = {v}" for k, v in index_params.items())
+
+                # An existing index is kept only if it was built the same way
                 cur.execute("""
-                    CREATE INDEX IF NOT EXISTS documents_embedding_idx 
-                    ON documents USING ivfflat (embedding vector_cosine_ops)
-                    WITH (lists = 100);
+                    SELECT am.amname, c.reloptions, pg_get_indexdef(c.oid)
+                    FROM pg_class c JOIN pg_am am ON am.oid = c.relam
+                    WHERE c.oid = to_regclass('documents_embedding_idx');
                 """)
+                existing = cur.fetchone()
+                self.conn.commit()
 
+            if existing and not rebuild:
+                amname, reloptions, indexdef = existing
+                if (amname == index_method
+                        and sorted(reloptions or []) == sorted(f"{k}={v}" for k, v in index_params.items())
+                        and ('binary_quantize' in indexdef) == (index_type == 'binary')):
+                    logger.info(f"✅ Vector index already exists ({index_type}, {index_options})")
+                    return True
+                logger.info(f"Rebuilding vector index ({amname}, {reloptions}) for ~{row_count} rows")
+
+            # Build under a temporary name with CONCURRENTLY so API reads and
+            # writes keep running; that needs autocommit, so the build settings
+            # are session-level and reset afterwards
+            self.conn.autocommit = True
+            try:
+                with self.conn.cursor() as cur:
+                    cur.execute("SET maintenance_work_mem = %s;", (maintenance_work_mem,))
+                    cur.execute("SET max_parallel_maintenance_workers = %s;", (parallel_workers,))
+                    # Remove an invalid leftover from an interrupted build
+                    cur.execute("DROP INDEX CONCURRENTLY IF EXISTS documents_embedding_idx_new;")
+                    cur.execute(f"""
+                        CREATE INDEX CONCURRENTLY documents_embedding_idx_new
+                        ON documents USING {index_method} ({index_key})
+                        WITH ({index_options});
+                    """)
+                    cur.execute("RESET maintenance_work_mem;")
+                    cur.execute("RESET max_parallel_maintenance_workers;")
+            finally:
+                self.conn.autocommit = False
+
+            # Swap the new index in; the exclusive lock is held only for the rename
+            with self.conn.cursor() as cur:
+                cur.execute("DROP INDEX IF EXISTS documents_embedding_idx;")
+                cur.execute("ALTER INDEX documents_embedding_idx_new RENAME TO documents_embedding_idx;")
                 self.conn.commit()
-                logger.info("✅ pgvector initialized and tables created")
-                return True
+
+            logger.info(f"✅ Vector index ready ({index_type}, ~{row_count} rows, {index_options})")
+            return True
         except Exception as e:
-            logger.error(f"❌ Failed to initialize pgvector: {e}")
+            logger.error(f"❌ Failed to create vector index: {e}")
             self.conn.rollback()
             return False
 
-    def load_embedding_model(self, model_name='all-MiniLM-L6-v2'):
+    @staticmethod
+    def _hnsw_params(row_count):
+        """
+        Choose HNSW build parameters for the expected table size
+
+        Args:
+            row_count (int): Number of rows in the documents table
+
+        Returns:
+            tuple: (m, ef_construction)
+        """
+        if row_count < 100_000:
+            return 16, 64
+        if row_count < 1_000_000:
+            return 24, 100
+        return 32, 128
+
+    @staticmethod
+    def _ivfflat_lists(row_count):
+        """
+        Choose the IVFFlat list count recommended by pgvector
+
+        Args:
+            row_count (int): Number of rows in the documents table
+
+        Returns:
+            int: rows / 1000 up to 1M rows, sqrt(rows) above
+        """
+        if row_count <= 1_000_000:
+            lists = row_count // 1000
+        else:
+            lists = int(math.sqrt(row_count))
+        return max(1, min(lists, 32768))
+
+    def load_embedding_model(self, model_name='all-MiniLM-L6-v2', backend=None, model_file=None):
         """
         Load sentence transformer model for embeddings
 
         Args:
             model_name (str): HuggingFace model name
+            backend (str): "torch", "onnx" or "openvino". Defaults to "torch"
+                on CUDA and "onnx" on CPU
+            model_file (str): Exported model file for the onnx/openvino
+                backends, e.g. "onnx/model_qint8_avx512_vnni.onnx"
         """
         try:
             logger.info(f"Loading embedding model: {model_name}")
-            self.model = SentenceTransformer(model_name)
+            self.model = None
+            backend = backend or ('torch' if torch.cuda.is_available() else 'onnx')
+
+            if backend != 'torch':
+                model_kwargs = {"file_name": model_file} if model_file else {}
+                try:
+                    self.model = SentenceTransformer(
+                        model_name, backend=backend, model_kwargs=model_kwargs
+                    )
+                    logger.info(f"Using {backend} backend")
+                except Exception as e:
+                    logger.warning(f"⚠️  {backend} backend load failed, falling back to torch: {e}")
+
+            torch_dtype = self._inference_dtype()
+            if self.model is None and torch_dtype:
+                try:
+                    self.model = SentenceTransformer(
+                        model_name, model_kwargs={"torch_dtype": torch_dtype}
+                    )
+                    logger.info(f"Using {torch_dtype} inference")
+                except Exception as e:
+                    logger.warning(f"⚠️  {torch_dtype} load failed, falling back to float32: {e}")
+            if self.model is None:
+                self.model = SentenceTransformer(model_name)
             self.embedding_dim = self.model.get_sentence_embedding_dimension()
             logger.info(f"✅ Model loaded. Embedding dimension: {self.embedding_dim}")
             return True
@@ -104,6 +266,18 @@ class PgVectorETL:
             logger.error(f"❌ Failed to load model: {e}")
             return False
 
+    @staticmethod
+    def _inference_dtype():
+        """
+        Pick a half-precision dtype for the encoder when the device supports it
+
+        Returns:
+            str: "bfloat16" or "float16" on CUDA, None to keep float32 on CPU
+        """
+        if not torch.cuda.is_available():
+            return None
+        return "bfloat16" if torch.cuda.is_bf16_supported() else "float16"
+
     def extract_documents(self, source_path):
         """
         Extract documents from source directory
@@ -114,41 +288,129 @@ class PgVectorETL:
         Returns:
             list: List of document dictionaries
         """
-        documents = []
+        documents = [doc for batch in self.iter_documents(source_path) for doc in batch]
+        logger.info(f"✅ Total documents extracted: {len(documents)}")
+        return documents
+
+    def iter_documents(self, source_path, batch_size=256):
+        """
+        Extract documents from source directory in batches
+
+        Args:
+            source_path (str): Path to documents directory
+            batch_size (int): Files read per batch
+
+        Yields:
+            list: Non-empty lists of document dictionaries
+        """
         source = Path(source_path)
 
         if not source.exists():
             logger.error(f"❌ Source path does not exist: {source_path}")
+            return
+
+        # Support for text files; reads are I/O bound so fan them out
+        paths = list(source.rglob('*.txt'))
+        max_workers = min(32, (os.cpu_count() or 1) * 4)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for start in range(0, len(paths), batch_size):
+                batch = [
+                    doc for doc in executor.map(self._extract_file, paths[start:start + batch_size])
+                    if doc is not None
+                ]
+                if batch:
+                    yield batch
+
+    def _extract_file(self, file_path):
+        """
+        Read a single text file into a document dictionary
+
+        Args:
+            file_path (Path): Path to the text file
+
+        Returns:
+            dict: Document dictionary, or None if the file could not be read
+        """
+        try:
+            size = os.stat(file_path).st_size
+            with open(file_path, 'rb') as f:
+                content = f.read().decode('utf-8')
+
+            logger.info(f"✅ Extracted: {file_path.name}")
+            return {
+                'content': content,
+                'metadata': {
+                    'filename': file_path.name,
+                    'filepath': str(file_path),
+                    'file_type': 'txt',
+                    'size': size
+                }
+            }
+        except Exception as e:
+            logger.error(f"❌ Failed to extract {file_path}: {e}")
+            return None
+
+    def chunk_documents(self, documents, overlap=32):
+        """
+        Split documents into chunks that fit the model's context window
+
+        Text past the model's max sequence length would be truncated, so each
+        document becomes overlapping token windows, sliced from the original
+        text via the tokenizer's offset mapping.
+
+        Args:
+            documents (list): List of document dictionaries
+            overlap (int): Tokens shared between consecutive chunks
+
+        Returns:
+            list: Chunk dictionaries with metadata.chunk_idx set
+        """
+        if not self.model:
+            logger.error("❌ Model not loaded. Call load_embedding_model() first")
             return documents
 
-        # Support for text files
-        for file_path in source.rglob('*.txt'):
+        tokenizer = self.model.tokenizer
+        window = self.model.max_seq_length - 2  # Room for [CLS] and [SEP]
+        step = max(window - overlap, 1)
+        chunks = []
+
+        for doc in documents:
+            content = doc['content']
             try:
-                with open(file_path, 'r', encoding='utf-8') as f:
-                    content = f.read()
-
-                documents.append({
-                    'content': content,
-                    'metadata': {
-                        'filename': file_path.name,
-                        'filepath': str(file_path),
-                        'file_type': 'txt',
-                        'size': file_path.stat().st_size
-                    }
-                })
-                logger.info(f"✅ Extracted: {file_path.name}")
+                offsets = tokenizer(
+                    content,
+                    add_special_tokens=False,
+                    return_offsets_mapping=True,
+                    verbose=False
+                )['offset_mapping']
             except Exception as e:
-                logger.error(f"❌ Failed to extract {file_path}: {e}")
+                logger.error(f"❌ Failed to tokenize {doc['metadata'].get('filename')}: {e}")
+                offsets = []
+
+            start, chunk_idx = 0, 0
+            while True:
+                window_offsets = offsets[start:start + window]
+                text = (content[window_offsets[0][0]:window_offsets[-1][1]]
+                        if window_offsets else content)
+                chunks.append({
+                    'content': text,
+                    'metadata': {**doc['metadata'], 'chunk_idx': chunk_idx}
+                })
+                if start + window >= len(offsets):
+                    break
+                start += step
+                chunk_idx += 1
 
-        logger.info(f"✅ Total documents extracted: {len(documents)}")
-        return documents
+        logger.info(f"✅ Split {len(documents)} documents into {len(chunks)} chunks")
+        return chunks
 
-    def generate_embeddings(self, documents):
+    def generate_embeddings(self, documents, batch_size=64):
         """
         Generate embeddings for documents
 
         Args:
             documents (list): List of document dictionaries
+            batch_size (int): Number of texts per model forward pass
 
         Returns:
             list: Documents with embeddings added
@@ -159,21 +421,55 @@ class PgVectorETL:
 
         logger.info(f"Generating embeddings for {len(documents)} documents...")
 
-        for i, doc in enumerate(documents):
-            try:
-                # Generate embedding
-                embedding = self.model.encode(doc['content'])
-                doc['embedding'] = embedding.tolist()
+        # Encode shortest first so every batch pads to a similar length;
+        # encode() only length-sorts within a single call
+        order = np.argsort(self._token_lengths(documents), kind='stable')
 
-                if (i + 1) % 10 == 0:
-                    logger.info(f"  Progress: {i + 1}/{len(documents)} documents")
+        # Encode in chunks of several batches so progress is logged and a
+        # failure only drops the documents of the chunk it happened in
+        chunk_size = batch_size * 16
+        for start in range(0, len(documents), chunk_size):
+            chunk = [documents[i] for i in order[start:start + chunk_size]]
+            texts = [doc['content'] for doc in chunk]
+            try:
+                embeddings = self.model.encode(
+                    texts,
+                    batch_size=batch_size,
+                    convert_to_numpy=True,
+                    normalize_embeddings=True
+                )
+                for doc, embedding in zip(chunk, embeddings):
+                    doc['embedding'] = embedding
+
+                logger.info(f"  Progress: {start + len(chunk)}/{len(documents)} documents")
             except Exception as e:
-                logger.error(f"❌ Failed to generate embedding for document {i}: {e}")
-                doc['embedding'] = None
+                logger.error(f"❌ Failed to generate embeddings for {len(chunk)} documents: {e}")
+                for doc in chunk:
+                    doc['embedding'] = None
 
         logger.info("✅ Embeddings generated")
         return documents
 
+    def _token_lengths(self, documents):
+        """
+        Count tokens per document, falling back to character length
+
+        Args:
+            documents (list): List of document dictionaries
+
+        Returns:
+            list: Length of each document's content
+        """
+        texts = [doc['content'] for doc in documents]
+        try:
+            input_ids = self.model.tokenizer(
+                texts, add_special_tokens=False, verbose=False
+            )['input_ids']
+            return [len(ids) for ids in input_ids]
+        except Exception as e:
+            logger.warning(f"⚠️  Tokenizer length count failed, sorting by characters: {e}")
+            return [len(text) for text in texts]
+
     def load_to_pgvector(self, documents):
         """
         Load documents with embeddings into PostgreSQL
@@ -185,24 +481,20 @@ class PgVectorETL:
             int: Number of documents loaded
         """
         loaded_count = 0
+        rows = [
+            (doc['content'], json.dumps(doc['metadata']), doc['embedding'])
+            for doc in documents
+            if doc.get('embedding') is not None
+        ]
 
         try:
             with self.conn.cursor() as cur:
-                for doc in documents:
-                    if doc.get('embedding') is None:
-                        continue
-
-                    cur.execute("""
-                        INSERT INTO documents (content, metadata, embedding)
-                        VALUES (%s, %s, %s)
-                    """, (
-                        doc['content'],
-                        json.dumps(doc['metadata']),
-                        doc['embedding']
-                    ))
-                    loaded_count += 1
-
+                cur.copy_expert(
+                    "COPY documents (content, metadata, embedding) FROM STDIN WITH (FORMAT binary)",
+                    self._copy_buffer(rows)
+                )
                 self.conn.commit()
+                loaded_count = len(rows)
                 logger.info(f"✅ Loaded {loaded_count} documents into pgvector")
         except Exception as e:
             logger.error(f"❌ Failed to load documents: {e}")
@@ -210,13 +502,135 @@ class PgVectorETL:
 
         return loaded_count
 
-    def run_etl(self, source_path, model_name='all-MiniLM-L6-v2'):
+    @staticmethod
+    def _copy_buffer(rows):
+        """
+        Encode rows as a PostgreSQL binary COPY stream
+
+        Args:
+            rows (list): (content, metadata_json, embedding) tuples
+
+        Returns:
+            io.BytesIO: Stream for COPY ... FROM STDIN WITH (FORMAT binary)
+        """
+        buf = io.BytesIO()
+        buf.write(PGCOPY_HEADER)
+        for content, metadata, embedding in rows:
+            content = content.encode('utf-8')
+            # jsonb binary input is a version byte followed by the JSON text
+            metadata = b'\x01' + metadata.encode('utf-8')
+            # halfvec binary input is int16 dim, int16 unused, float2[dim]
+            vector = np.asarray(embedding, dtype='>f2')
+            embedding = struct.pack('!hh', len(vector), 0) + vector.tobytes()
+
+            buf.write(struct.pack('!h', 3))
+            for field in (content, metadata, embedding):
+                buf.write(struct.pack('!i', len(field)))
+                buf.write(field)
+        buf.write(PGCOPY_TRAILER)
+        buf.seek(0)
+        return buf
+
+    def run_pipeline(self, source_path, batch_size=64, docs_per_batch=256, queue_depth=4):
+        """
+        Extract, embed and load documents as overlapping stages
+
+        Extraction and loading run on their own threads and exchange batches
+        with the embedding stage through bounded queues, so file reads and
+        database writes overlap with model inference and memory is capped at
+        a few batches instead of the whole corpus.
+
+        Args:
+            source_path (str): Path to documents directory
+            batch_size (int): Embedding batch size
+            docs_per_batch (int): Source files per pipeline batch
+            queue_depth (int): Batches buffered between stages
+
+        Returns:
+            tuple: (documents extracted, rows loaded)
+        """
+        extracted = queue.Queue(maxsize=queue_depth)
+        embedded = queue.Queue(maxsize=queue_depth)
+        counts = {'extracted': 0, 'loaded': 0}
+        # Exceptions from the stage threads, re-raised once they have stopped
+        errors = []
+
+        def extract_stage():
+            try:
+                for batch in self.iter_documents(source_path, docs_per_batch):
+                    if errors:
+                        break
+                    counts['extracted'] += len(batch)
+                    extracted.put(batch)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                extracted.put(None)
+
+        def load_stage():
+            while True:
+                batch = embedded.get()
+                if batch is None:
+                    break
+                # After a failure keep draining so the embedding stage never blocks
+                if errors:
+                    continue
+                try:
+                    counts['loaded'] += self.load_to_pgvector(batch)
+                except Exception as e:
+                    errors.append(e)
+
+        threads = [
+            threading.Thread(target=extract_stage, name='etl-extract'),
+            threading.Thread(target=load_stage, name='etl-load')
+        ]
+        for thread in threads:
+            thread.start()
+
+        extract_done = False
+        try:
+            while not errors:
+                batch = extracted.get()
+                if batch is None:
+                    extract_done = True
+                    break
+                chunks = self.chunk_documents(batch)
+                embedded.put(self.generate_embeddings(chunks, batch_size))
+        except Exception as e:
+            # Recorded so the extractor stops instead of reading the rest
+            errors.append(e)
+            raise
+        finally:
+            embedded.put(None)
+            # Drain so the extractor is not left blocked if embedding stopped early
+            while not extract_done:
+                extract_done = extracted.get() is None
+            for thread in threads:
+                thread.join()
+
+        if errors:
+            raise errors[0]
+
+        logger.info(f"✅ Total documents extracted: {counts['extracted']}")
+        return counts['extracted'], counts['loaded']
+
+    def run_etl(self, source_path, model_name='all-MiniLM-L6-v2', batch_size=64,
+                backend=None, model_file=None, maintenance_work_mem='2GB',
+                parallel_workers=3, index_type='hnsw', rebuild_index=False):
         """
         Run complete ETL pipeline
 
         Args:
             source_path (str): Path to documents directory
             model_name (str): Embedding model name
+            batch_size (int): Embedding batch size
+            backend (str): Embedding inference backend
+            model_file (str): Exported model file for non-torch backends
+            maintenance_work_mem (str): Memory for the vector index build
+            parallel_workers (int): Parallel workers for the vector index build
+            index_type (str): Vector index type, "hnsw" or "ivfflat"
+            rebuild_index (bool): Rebuild the vector index even if its parameters
+                already match the new row count
 
         Returns:
             bool: Success status
@@ -229,25 +643,24 @@ class PgVectorETL:
         if not self.connect_db():
             return False
 
-        # Step 2: Initialize pgvector
-        if not self.initialize_pgvector():
+        # Step 2: Load embedding model (sets the embedding dimension)
+        if not self.load_embedding_model(model_name, backend, model_file):
             return False
 
-        # Step 3: Load embedding model
-        if not self.load_embedding_model(model_name):
+        # Step 3: Initialize pgvector
+        if not self.initialize_pgvector():
             return False
 
-        # Step 4: Extract documents
-        documents = self.extract_documents(source_path)
-        if not documents:
+        # Step 4: Extract, chunk, embed and load documents as a pipeline
+        extracted_count, loaded_count = self.run_pipeline(source_path, batch_size)
+        if not extracted_count:
             logger.warning("⚠️  No documents found to process")
             return False
 
-        # Step 5: Generate embeddings
-        documents = self.generate_embeddings(documents)
-
-        # Step 6: Load to pgvector
-        loaded_count = self.load_to_pgvector(documents)
+        # Step 5: Build vector index over the loaded rows
+        if not self.create_vector_index(maintenance_work_mem, parallel_workers,
+                                        index_type, rebuild_index):
+            return False
 
         logger.info("=" * 80)
         logger.info(f"✅ ETL Pipeline Complete! Loaded {loaded_count} documents")
@@ -279,12 +692,23 @@ def main():
 
     # Embedding model
     model_name = os.getenv('EMBEDDING_MODEL', 'all-MiniLM-L6-v2')
+    batch_size = int(os.getenv('EMB_BATCH', 64))
+    backend = os.getenv('EMBEDDING_BACKEND')
+    model_file = os.getenv('EMBEDDING_MODEL_FILE')
+
+    # Vector index build settings
+    maintenance_work_mem = os.getenv('INDEX_MAINTENANCE_WORK_MEM', '2GB')
+    parallel_workers = int(os.getenv('INDEX_PARALLEL_WORKERS', 3))
+    index_type = os.getenv('INDEX_TYPE', 'hnsw')
+    rebuild_index = os.getenv('INDEX_REBUILD', 'false').lower() == 'true'
 
     # Initialize and run ETL
     etl = PgVectorETL(db_config)
 
     try:
-        success = etl.run_etl(source_path, model_name)
+        success = etl.run_etl(source_path, model_name, batch_size, backend, model_file,
+                              maintenance_work_mem, parallel_workers,
+                              index_type, rebuild_index)
         sys.exit(0 if success else 1)
     except Exception as e:
         logger.error(f"❌ ETL pipeline failed: {e}")